@@ -12,8 +12,10 @@ Updated by Gergely Polonkai at GT2.
 :license: BSD, see LICENSE for more details.
 '''
 
-from cassandra.auth import PlainTextAuthProvider
-from cassandra.cluster import Cluster
+import atexit
+import sys
+import threading
+from collections import OrderedDict
 
 try:
     from flask import _app_ctx_stack as stack
@@ -32,18 +34,85 @@ except NameError:
     # Python 3 doesn’t have unicode, only str
     string_types = (str,)
 
+# The Cassandra driver is imported lazily, on first use, so merely importing
+# this module stays cheap.  These are bound by the functions below.
+PlainTextAuthProvider = None
+Cluster = None
+execute_concurrent_with_args = None
+HostDistance = None
+
+
+def _import_auth_provider():
+    global PlainTextAuthProvider
+
+    if PlainTextAuthProvider is None:
+        from cassandra.auth import PlainTextAuthProvider
+
+    return PlainTextAuthProvider
+
+
+def _import_cluster():
+    global Cluster, HostDistance
+
+    if Cluster is None:
+        from cassandra.cluster import Cluster
+
+    if HostDistance is None:
+        from cassandra.policies import HostDistance
+
+    return Cluster
+
+
+def _import_execute_concurrent():
+    global execute_concurrent_with_args
+
+    if execute_concurrent_with_args is None:
+        from cassandra.concurrent import execute_concurrent_with_args
+
+    return execute_concurrent_with_args
+
 
 class CassandraCluster(object):
     """
     Cassandra cluster access for Flask apps.
     """
 
+    # Names starting with two underscores are mangled here just like they
+    # are in methods
+    __slots__ = (
+        'app',
+        'cluster',
+        '__primary_session',
+        '__session',
+        '__queries',
+        '__cql_to_prepared',
+        '__queries_max_size',
+        '_cluster_lock',
+        '_session_lock',
+        '_queries_lock',
+        'nodes',
+        'port',
+        'user',
+        'password',
+        'keyspace',
+        'default_consistency_level',
+        'auth_provider',
+        'cluster_options',
+        'core_connections_per_host',
+        'max_requests_per_connection',
+    )
+
     def __init__(self, app=None):
         self.app = app
         self.cluster = None
         self.__primary_session = None
         self.__session = {}
-        self.__queries = {}
+        self.__queries = OrderedDict()
+        self.__cql_to_prepared = OrderedDict()
+        self.__queries_max_size = 512
+        self._cluster_lock = threading.Lock()
+        self._session_lock = threading.Lock()
+        self._queries_lock = threading.Lock()
 
         self.nodes = []
         self.port = 9042
@@ -51,6 +120,10 @@ class CassandraCluster(object):
         self.password = None
         self.keyspace = None
         self.default_consistency_level = None
+        self.auth_provider = None
+        self.cluster_options = {}
+        self.core_connections_per_host = None
+        self.max_requests_per_connection = None
 
         if app is not None:
             self.init_app(app)
@@ -63,6 +136,15 @@ class CassandraCluster(object):
         app.config.setdefault('CASSANDRA_USER', None)
         app.config.setdefault('CASSANDRA_PASSWORD', None)
         app.config.setdefault('CASSANDRA_KEYSPACE', None)
+        app.config.setdefault('CASSANDRA_PREPARED_CACHE_SIZE', 512)
+        app.config.setdefault('CASSANDRA_EXECUTOR_THREADS', None)
+        app.config.setdefault('CASSANDRA_PROTOCOL_VERSION', None)
+        app.config.setdefault('CASSANDRA_COMPRESSION', None)
+        app.config.setdefault('CASSANDRA_CORE_CONNECTIONS_PER_HOST', None)
+        app.config.setdefault('CASSANDRA_MAX_REQUESTS_PER_CONNECTION', None)
+        app.config.setdefault('CASSANDRA_SKIP_SCHEMA_REFRESH', False)
+        app.config.setdefault('CASSANDRA_PREWARM_KEYSPACES', None)
+        app.config.setdefault('CASSANDRA_PREPARE_ON_STARTUP', None)
 
         # Let’s be on the safe side, and convert CASSANDRA_NODES to a list
         # if it’s a string
@@ -76,26 +158,106 @@ class CassandraCluster(object):
         self.user = app.config['CASSANDRA_USER']
         self.password = app.config['CASSANDRA_PASSWORD']
         self.keyspace = app.config['CASSANDRA_KEYSPACE']
+
+        # Keyspace names are used as session cache keys on every query;
+        # interned strings make those lookups an identity check
+        if self.keyspace:
+            self.keyspace = sys.intern(self.keyspace)
         self.default_consistency_level = app.config['CASSANDRA_CONSISTENCY_LEVEL']
+        self.__queries_max_size = app.config['CASSANDRA_PREPARED_CACHE_SIZE']
+
+        # `None` means the prepared statement cache is unbounded
+        max_size = self.__queries_max_size
+
+        if max_size is not None and (isinstance(max_size, bool) or
+                                     not isinstance(max_size, int) or
+                                     max_size < 1):
+            raise ValueError('CASSANDRA_PREPARED_CACHE_SIZE must be a '
+                             'positive integer or None, not {!r}'
+                             .format(max_size))
+
+        # If there is authentication data in the config, let’s use it
+        # FIXME: this may not be compatible with older Cassandra
+        # versions, but do we really want to support that?
+        if self.user and self.password:
+            self.auth_provider = _import_auth_provider()(self.user,
+                                                         self.password)
+        else:
+            self.auth_provider = None
+
+        self.core_connections_per_host = \
+            app.config['CASSANDRA_CORE_CONNECTIONS_PER_HOST']
+        self.max_requests_per_connection = \
+            app.config['CASSANDRA_MAX_REQUESTS_PER_CONNECTION']
+
+        # The driver only supports these with protocol versions 1 and 2, and
+        # would fail on every connection attempt otherwise
+        if (self.core_connections_per_host is not None or
+                self.max_requests_per_connection is not None) and \
+                app.config['CASSANDRA_PROTOCOL_VERSION'] not in (1, 2):
+            raise ValueError('CASSANDRA_CORE_CONNECTIONS_PER_HOST and '
+                             'CASSANDRA_MAX_REQUESTS_PER_CONNECTION require '
+                             'CASSANDRA_PROTOCOL_VERSION 1 or 2')
+
+        # Only pass the tuning options that are set, so the driver’s own
+        # defaults apply to everything else
+        self.cluster_options = {}
+
+        for option, key in (('executor_threads', 'CASSANDRA_EXECUTOR_THREADS'),
+                            ('protocol_version', 'CASSANDRA_PROTOCOL_VERSION'),
+                            ('compression', 'CASSANDRA_COMPRESSION')):
+            if app.config[key] is not None:
+                self.cluster_options[option] = app.config[key]
+
+        if app.config['CASSANDRA_SKIP_SCHEMA_REFRESH']:
+            self.cluster_options['schema_metadata_enabled'] = False
+
+        # If there is an old Cluster, shut it down; we will probably create
+        # a new one
+        if self.cluster is not None:
+            atexit.unregister(self.cluster.shutdown)
+            self.cluster.shutdown()
 
         # It is possible we are being reinitialised with different
         # parameters, so let’s reset sessions
-        self.__sessions = {}
-        self.__queries = {}
+        self.__session = {}
+        self.__queries = OrderedDict()
+        self.__cql_to_prepared = OrderedDict()
         self.cluster = None
 
-        # If there is an old CassandraCluster, shut it down; we will
-        # probably create a new one
-        ctx = stack.top
-
-        if hasattr(ctx, 'cassandra_cluster'):
-            ctx.cassandra_cluster.shutdown()
-
         if hasattr(app, 'teardown_appcontext'):
             app.teardown_appcontext(self.teardown)
         else:
             app.teardown_request(self.teardown)
 
+        # Connect to the listed keyspaces in the background, so the first
+        # requests don’t have to wait for the connection handshake
+        if app.config['CASSANDRA_PREWARM_KEYSPACES']:
+            threading.Thread(target=self._prewarm, daemon=True).start()
+
+    def _prewarm(self):
+        """
+        Connect to every keyspace in `CASSANDRA_PREWARM_KEYSPACES`, and
+        prepare the queries in `CASSANDRA_PREPARE_ON_STARTUP` for each of
+        them
+        """
+
+        queries = self.app.config['CASSANDRA_PREPARE_ON_STARTUP'] or {}
+        keyspaces = self.app.config['CASSANDRA_PREWARM_KEYSPACES']
+
+        if isinstance(keyspaces, string_types):
+            keyspaces = [keyspaces]
+
+        for keyspace in keyspaces:
+            try:
+                self.connect(keyspace=keyspace)
+
+                for query_name, query in queries.items():
+                    self.prepare_query(query_name, query, keyspace=keyspace)
+            except Exception:
+                self.app.logger.exception(
+                    'Could not prewarm Cassandra keyspace %s', keyspace)
+
     @property
     def session(self):
         """
@@ -106,7 +268,7 @@ class CassandraCluster(object):
         `app.config['CASSANDRA_KEYSPACE']` (so it must be set.)
         """
 
-        return self.connect(keyspace=self.keyspace)
+        return self._resolve(self.keyspace)
 
     def get_session(self, keyspace):
         """
@@ -116,7 +278,12 @@ class CassandraCluster(object):
         :type keyspace: str, None
         """
 
-        return self.connect(keyspace=keyspace)
+        return self._resolve(keyspace)
+
+    def _resolve(self, keyspace):
+        # Return an existing session directly; only `connect` creates new
+        # ones
+        return self.__session.get(keyspace) or self.connect(keyspace=keyspace)
 
     def prepare_query(self, query_name, query, keyspace=None, force=False):
         """
@@ -133,20 +300,69 @@ class CassandraCluster(object):
         """
 
         keyspace = keyspace or self.keyspace
-        session = self.connect(keyspace=keyspace)
-
-        if keyspace not in self.__queries:
-            self.__queries[keyspace] = {}
+        session = self._resolve(keyspace)
+        key = (keyspace, query_name)
+        # The same CQL may have been prepared under a different name; reuse
+        # that statement instead of preparing it again.  Only surrounding
+        # whitespace is ignored, as whitespace inside string literals is
+        # significant
+        cql_key = (keyspace, query.strip())
+        prepared = None
+
+        # The caches are shared between threads, so a lookup and the LRU
+        # update following it must not be interleaved with evictions
+        if not force:
+            with self._queries_lock:
+                prepared = self.__queries.get(key)
+
+                if prepared is not None:
+                    self.__queries.move_to_end(key)
+
+                    return prepared
+
+                prepared = self.__cql_to_prepared.get(cql_key)
+
+        # Don’t hold the lock during the round-trip to the server
+        if prepared is None:
+            prepared = session.prepare(query)
+
+        with self._queries_lock:
+            self.__queries[key] = prepared
+            self.__queries.move_to_end(key)
+            self.__cql_to_prepared[cql_key] = prepared
+            self.__cql_to_prepared.move_to_end(cql_key)
+
+            # Evict the least recently used statements so the caches do
+            # not grow without bounds.  As the size is at least 1, the
+            # statement just stored is never evicted here.
+            if self.__queries_max_size is not None:
+                while len(self.__queries) > self.__queries_max_size:
+                    self.__queries.popitem(last=False)
+
+                while len(self.__cql_to_prepared) > self.__queries_max_size:
+                    self.__cql_to_prepared.popitem(last=False)
+
+        return prepared
+
+    def cache_info(self):
+        """
+        Get statistics about the prepared statement cache
 
-        if force or query_name not in self.__queries[keyspace]:
-            self.__queries[keyspace][query_name] = session.prepare(query)
+        :returns: a dictionary with the current number of cached statements
+                  (`size`) and the maximum number of statements kept
+                  (`max_size`, `None` if the cache is unbounded)
+        :rtype: dict
+        """
 
-        return self.__queries[keyspace][query_name]
+        return {
+            'size': len(self.__queries),
+            'max_size': self.__queries_max_size,
+        }
 
     def execute_prepared(self, query_name,
                          keyspace=None,
                          query=None,
-                         params=[]):
+                         params=()):
         """
         Execute a named query that has been prepared with `prepare_query`
 
@@ -159,7 +375,7 @@ class CassandraCluster(object):
         :param params: Parameters to pass to the query.
         :type query_name: str
         :type query: str
-        :type params: list
+        :type params: tuple
         :returns: the result of the query execution
         :rtype: cassandra.cluster.ResultSet
         :raises ValueError: if there is no query prepared with `query_name`,
@@ -167,96 +383,200 @@ class CassandraCluster(object):
         """
 
         keyspace = keyspace or self.keyspace
-        session = self.connect(keyspace=keyspace)
+        session = self._resolve(keyspace)
+        prepared = self._get_prepared(query_name, keyspace, query)
+
+        return session.execute(prepared, params)
+
+    def execute_prepared_async(self, query_name,
+                               keyspace=None,
+                               query=None,
+                               params=()):
+        """
+        Execute a named query asynchronously
+
+        This works like `execute_prepared`, but doesn’t wait for the
+        result.  Use `gather_async` to wait for several futures at once.
+
+        :param query_name: The name that was used in a call to
+                           `prepare_query`
+        :param query: A CQL query, used the same way as in
+                      `execute_prepared`
+        :param params: Parameters to pass to the query.
+        :type query_name: str
+        :type query: str
+        :type params: tuple
+        :returns: a future for the query execution
+        :rtype: cassandra.cluster.ResponseFuture
+        :raises ValueError: if there is no query prepared with `query_name`,
+                             and `query` is not specified
+        """
+
+        keyspace = keyspace or self.keyspace
+        session = self._resolve(keyspace)
+        prepared = self._get_prepared(query_name, keyspace, query)
+
+        return session.execute_async(prepared, params)
+
+    @staticmethod
+    def gather_async(futures):
+        """
+        Wait for the results of several futures
+
+        :param futures: futures returned by `execute_prepared_async`
+        :returns: the results, in the same order as `futures`
+        :rtype: list
+        :raises Exception: the error of the first failed query
+        """
+
+        return [future.result() for future in futures]
+
+    def execute_many_prepared(self, query_name, params_list,
+                              keyspace=None,
+                              query=None,
+                              concurrency=100):
+        """
+        Execute a named query concurrently, once for each set of parameters
+
+        :param query_name: The name that was used in a call to
+                           `prepare_query`
+        :param params_list: A sequence of parameters, one for each execution
+        :param query: A CQL query, used the same way as in
+                      `execute_prepared`
+        :param concurrency: The maximum number of queries running at the
+                            same time
+        :type query_name: str
+        :type query: str
+        :type concurrency: int
+        :returns: a generator of `(success, result_or_exception)` tuples,
+                  in the order of `params_list`
+        :raises ValueError: if there is no query prepared with `query_name`,
+                             and `query` is not specified
+        """
+
+        keyspace = keyspace or self.keyspace
+        session = self._resolve(keyspace)
+        prepared = self._get_prepared(query_name, keyspace, query)
+
+        execute_concurrent = _import_execute_concurrent()
+
+        return execute_concurrent(session, prepared, params_list,
+                                  concurrency=concurrency,
+                                  results_generator=True)
+
+    def _get_prepared(self, query_name, keyspace, query):
+        key = (keyspace, query_name)
+
+        with self._queries_lock:
+            prepared = self.__queries.get(key)
 
-        if keyspace not in self.__queries:
-            self.__queries[keyspace] = {}
+            if prepared is not None:
+                self.__queries.move_to_end(key)
 
-        if query_name not in self.__queries[keyspace]:
-            if query is None:
-                raise ValueError('No query prepared with name "{}" and '
-                                 'query is not specified.'.format(query_name))
-            else:
-                self.prepare_query(query_name, query, keyspace=keyspace)
+                return prepared
 
-        return session.execute(self.__queries[query_name], params)
+        if query is None:
+            raise ValueError('No query prepared with name "{}" and '
+                             'query is not specified.'.format(query_name))
+
+        return self.prepare_query(query_name, query, keyspace=keyspace)
 
     def connect(self, keyspace=None, level=None):
+        sessions = self.__session
         keyspace = keyspace or self.keyspace
 
+        # Fast path: if we already have a session to a keyspace, reuse it.
+        session = sessions.get(keyspace)
+
+        if session is not None:
+            return session
+
         # If we already have a Cluster object, reuse it.  Otherwise, create
-        # a new one.
+        # a new one.  The check is repeated under the lock so concurrent
+        # first requests create only one cluster.
         if self.cluster is None:
-            self.cluster = Cluster(
-                self.nodes,
-                port=9042)
-            # If there is authentication data in the config, let’s use it
-            # FIXME: this may not be compatible with older Cassandra
-            # versions, but do we really want to support that?
-            if self.user and self.password:
-                self.cluster.auth_provider = PlainTextAuthProvider(
-                    self.user, self.password)
+            with self._cluster_lock:
+                if self.cluster is None:
+                    cluster = _import_cluster()(
+                        self.nodes,
+                        port=self.port,
+                        auth_provider=self.auth_provider,
+                        **self.cluster_options)
+
+                    # These are only set with protocol versions 1 and 2;
+                    # init_app makes sure of that
+                    if self.core_connections_per_host is not None:
+                        cluster.set_core_connections_per_host(
+                            HostDistance.LOCAL,
+                            self.core_connections_per_host)
+
+                    if self.max_requests_per_connection is not None:
+                        cluster.set_max_requests_per_connection(
+                            HostDistance.LOCAL,
+                            self.max_requests_per_connection)
+
+                    # The cluster lives as long as the process does, so
+                    # shut its connection pool down only at exit
+                    atexit.register(cluster.shutdown)
+
+                    self.cluster = cluster
 
         if not keyspace:
             return None
 
-        # If we already have a session to a keyspace, reuse it.
-        if keyspace not in self.__session:
-            self.app.logger.debug(
-                "Connecting to Cassandra cluster at {}"
-                .format(self.nodes))
+        with self._session_lock:
+            # Another thread may have connected while we were waiting
+            session = sessions.get(keyspace)
+
+            if session is None:
+                self.app.logger.debug("Connecting to Cassandra cluster at %s",
+                                      self.nodes)
+
+                session = self.cluster.connect(keyspace=keyspace)
 
-            self.__session[keyspace] = self.cluster.connect(keyspace=keyspace)
+                if level:
+                    session.default_consistency_level = level
 
-            if level:
-                self.__session[keyspace].default_consistency_level = level
+                sessions[sys.intern(keyspace)] = session
 
-        return self.__session[keyspace]
+        return session
 
     def teardown(self, exception):
+        # Only drop the context’s reference; the cluster and its sessions
+        # are reused by later requests
         ctx = stack.top
 
         if hasattr(ctx, 'cassandra_cluster'):
-            ctx.cassandra_cluster.shutdown()
+            del ctx.cassandra_cluster
 
     @property
     def connection(self):
         ctx = stack.top
 
         if ctx is not None:
-            if not hasattr(ctx, 'cassandra_cluster'):
+            cluster = getattr(ctx, 'cassandra_cluster', None)
+
+            if cluster is None:
                 self.connect()
-                ctx.cassandra_cluster = self.cluster
+                cluster = ctx.cassandra_cluster = self.cluster
 
-            return ctx.cassandra_cluster
+            return cluster
 
     def __repr__(self):
-        auth_data = []
-
-        if self.user or self.password:
-            auth_data.append(self.user or '')
-            if self.password:
-                auth_data.append(self.password)
-
-        conn_string = 'cql://'
-
-        if self.user:
-            conn_string += self.user
-
         if self.password:
-            conn_string += ':' + self.password
-
-        hosts = ', '.join(self.nodes)
-
-        if len(self.nodes) != 1:
-            hosts = '[{}]'.format(hosts)
-
-        conn_string += hosts
+            auth = '{}:{}@'.format(self.user or '', self.password)
+        elif self.user:
+            auth = '{}@'.format(self.user)
+        else:
+            auth = ''
 
-        if self.port:
-            conn_string += str(self.port)
+        if len(self.nodes) == 1:
+            hosts = self.nodes[0]
+        else:
+            hosts = '[{}]'.format(', '.join(self.nodes))
 
-        if self.keyspace:
-            conn_string += '/' + self.keyspace
+        port = ':{}'.format(self.port) if self.port else ''
+        keyspace = '/{}'.format(self.keyspace) if self.keyspace else ''
 
-        return '<CassandraCluster {}>'.format(conn_string)
+        return '<CassandraCluster cql://{}{}{}{}>'.format(auth, hosts, port,
+                                                          keyspace)
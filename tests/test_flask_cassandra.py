@@ -1,6 +1,7 @@
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 
+from cassandra.policies import HostDistance
 from flask import Flask
 
 from utils.cassandra import CassandraCluster
@@ -30,7 +31,8 @@ class CassandraTestCase(TestCase):
         cluster = CassandraCluster(app=self.app)
         session = cluster.connect()
         # Default parameters
-        cluster_class.assert_called_once_with(['localhost'], port=9042)
+        cluster_class.assert_called_once_with(['localhost'], port=9042,
+                                              auth_provider=None)
         auth_class.assert_not_called()
         self.assertIsNone(session)
 
@@ -40,7 +42,8 @@ class CassandraTestCase(TestCase):
         session = cluster.connect()
         # Default parameters
         cluster_class.assert_called_once_with(['cassandra.example.com'],
-                                              port=9042)
+                                              port=9042,
+                                              auth_provider=None)
         self.assertIsNone(session)
         auth_class.assert_not_called()
 
@@ -50,14 +53,19 @@ class CassandraTestCase(TestCase):
         self.app.config['CASSANDRA_PORT'] = 1234
         cluster = CassandraCluster(app=self.app)
         session = cluster.connect()
-        cluster_class.assert_called_once_with(['cassandra.example.com'],
-                                              port=1234)
+        cluster_class.assert_called_once_with(
+            ['cassandra.example.com'],
+            port=1234,
+            auth_provider=auth_class.return_value)
         self.assertIsNone(session)
         auth_class.assert_called_once_with('username', 'password')
 
         old_cluster = cluster
+        cluster.connect(keyspace='keyspace')
         cluster.init_app(self.app)
         self.assertEqual(old_cluster, cluster)
+        # Reinitialising must drop the sessions of the old cluster
+        self.assertEqual(cluster._CassandraCluster__session, {})
         session = cluster.connect(keyspace='keyspace')
         # FIXME: Mock cluster.connect so it returns a different value for
         # the two calls.
@@ -83,3 +91,225 @@ class CassandraTestCase(TestCase):
         self.app.config['CASSANDRA_KEYSPACE'] = 'test'
         cluster.init_app(self.app)
         self.assertIsNotNone(cluster.session)
+
+    @patch('utils.cassandra.Cluster')
+    def test_prepared_cache_size(self, cluster_class):
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        self.app.config['CASSANDRA_PREPARED_CACHE_SIZE'] = 2
+        cluster = CassandraCluster(app=self.app)
+        session = cluster.session
+
+        first = cluster.prepare_query('first', 'SELECT 1')
+        cluster.prepare_query('second', 'SELECT 2')
+        # Touch the first query so the second one becomes the oldest
+        cluster.prepare_query('first', 'SELECT 1')
+        cluster.prepare_query('third', 'SELECT 3')
+
+        self.assertEqual(cluster.cache_info(), {'size': 2, 'max_size': 2})
+        self.assertEqual(session.prepare.call_count, 3)
+        self.assertIs(cluster.prepare_query('first', 'SELECT 1'), first)
+
+        cluster.prepare_query('second', 'SELECT 2')
+        self.assertEqual(cluster.cache_info(), {'size': 2, 'max_size': 2})
+
+        self.app.config['CASSANDRA_PREPARED_CACHE_SIZE'] = None
+        cluster.init_app(self.app)
+        for i in range(5):
+            cluster.prepare_query('query{}'.format(i), 'SELECT {}'.format(i))
+        self.assertEqual(cluster.cache_info(), {'size': 5, 'max_size': None})
+
+        for size in (0, -1, '10', True):
+            self.app.config['CASSANDRA_PREPARED_CACHE_SIZE'] = size
+            with self.assertRaises(ValueError):
+                cluster.init_app(self.app)
+
+    @patch('utils.cassandra.Cluster')
+    def test_prepare_same_query(self, cluster_class):
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        cluster = CassandraCluster(app=self.app)
+        session = cluster.session
+
+        first = cluster.prepare_query('first', 'SELECT * FROM t')
+        second = cluster.prepare_query('second', '  SELECT * FROM t\n')
+        self.assertIs(first, second)
+        session.prepare.assert_called_once_with('SELECT * FROM t')
+
+        cluster.prepare_query('second', 'SELECT * FROM t', force=True)
+        self.assertEqual(session.prepare.call_count, 2)
+
+    @patch('utils.cassandra.Cluster')
+    def test_prepare_different_literals(self, cluster_class):
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        cluster = CassandraCluster(app=self.app)
+        session = cluster.session
+        session.prepare.side_effect = [MagicMock(), MagicMock()]
+
+        first = cluster.prepare_query(
+            'a', "SELECT * FROM t WHERE name = 'a  b'")
+        second = cluster.prepare_query(
+            'b', "SELECT * FROM t WHERE name = 'a b'")
+        self.assertIsNot(first, second)
+        self.assertEqual(session.prepare.call_count, 2)
+
+    @patch('utils.cassandra.Cluster')
+    def test_execute_prepared(self, cluster_class):
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        cluster = CassandraCluster(app=self.app)
+        session = cluster.session
+
+        with self.assertRaises(ValueError):
+            cluster.execute_prepared('select')
+
+        for i in range(5):
+            cluster.execute_prepared('select',
+                                     query='SELECT * FROM t WHERE id = ?',
+                                     params=[i])
+
+        session.prepare.assert_called_once_with('SELECT * FROM t WHERE id = ?')
+        self.assertEqual(session.execute.call_count, 5)
+        session.execute.assert_called_with(session.prepare.return_value, [4])
+
+    @patch('utils.cassandra.Cluster')
+    def test_cluster_options(self, cluster_class):
+        self.app.config['CASSANDRA_EXECUTOR_THREADS'] = 4
+        self.app.config['CASSANDRA_PROTOCOL_VERSION'] = 2
+        self.app.config['CASSANDRA_COMPRESSION'] = False
+        self.app.config['CASSANDRA_CORE_CONNECTIONS_PER_HOST'] = 1
+        self.app.config['CASSANDRA_MAX_REQUESTS_PER_CONNECTION'] = 64
+        self.app.config['CASSANDRA_SKIP_SCHEMA_REFRESH'] = True
+        cluster = CassandraCluster(app=self.app)
+        cluster.connect()
+
+        cluster_class.assert_called_once_with(['localhost'], port=9042,
+                                              auth_provider=None,
+                                              executor_threads=4,
+                                              protocol_version=2,
+                                              compression=False,
+                                              schema_metadata_enabled=False)
+        cluster.cluster.set_core_connections_per_host.assert_called_once_with(
+            HostDistance.LOCAL, 1)
+        cluster.cluster.set_max_requests_per_connection.assert_called_once_with(
+            HostDistance.LOCAL, 64)
+
+        self.app.config['CASSANDRA_PROTOCOL_VERSION'] = None
+        with self.assertRaises(ValueError):
+            cluster.init_app(self.app)
+
+        self.app.config['CASSANDRA_PROTOCOL_VERSION'] = 4
+        with self.assertRaises(ValueError):
+            cluster.init_app(self.app)
+
+        self.app.config['CASSANDRA_CORE_CONNECTIONS_PER_HOST'] = None
+        with self.assertRaises(ValueError):
+            cluster.init_app(self.app)
+
+        self.app.config['CASSANDRA_MAX_REQUESTS_PER_CONNECTION'] = None
+        cluster.init_app(self.app)
+
+    @patch('utils.cassandra.Cluster')
+    def test_teardown(self, cluster_class):
+        cluster = CassandraCluster(app=self.app)
+
+        with self.app.app_context():
+            self.assertIs(cluster.connection, cluster_class.return_value)
+
+        cluster_class.return_value.shutdown.assert_not_called()
+        self.assertIs(cluster.cluster, cluster_class.return_value)
+
+    @patch('utils.cassandra.Cluster')
+    def test_reinit_shuts_down_cluster(self, cluster_class):
+        cluster = CassandraCluster(app=self.app)
+        cluster.connect()
+        old_cluster = cluster.cluster
+
+        cluster.init_app(self.app)
+        old_cluster.shutdown.assert_called_once_with()
+        self.assertIsNone(cluster.cluster)
+
+    @patch('utils.cassandra.threading.Thread')
+    @patch('utils.cassandra.Cluster')
+    def test_prewarm(self, cluster_class, thread_class):
+        self.app.config['CASSANDRA_PREWARM_KEYSPACES'] = ['one', 'two']
+        self.app.config['CASSANDRA_PREPARE_ON_STARTUP'] = {
+            'select': 'SELECT * FROM t',
+        }
+        cluster = CassandraCluster()
+        cluster.init_app(self.app)
+
+        thread_class.assert_called_once_with(target=cluster._prewarm,
+                                             daemon=True)
+        thread_class.return_value.start.assert_called_once_with()
+        cluster_class.assert_not_called()
+
+        # Run the thread’s target here, while the mocks are in place
+        thread_class.call_args[1]['target']()
+
+        connect = cluster_class.return_value.connect
+        connect.assert_any_call(keyspace='one')
+        connect.assert_any_call(keyspace='two')
+        self.assertEqual(cluster.cache_info()['size'], 2)
+
+    @patch('utils.cassandra.execute_concurrent_with_args')
+    @patch('utils.cassandra.Cluster')
+    def test_execute_many_prepared(self, cluster_class, execute_concurrent):
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        cluster = CassandraCluster(app=self.app)
+        session = cluster.session
+        params_list = [(1,), (2,), (3,)]
+
+        result = cluster.execute_many_prepared(
+            'insert', params_list,
+            query='INSERT INTO t (id) VALUES (?)',
+            concurrency=10)
+
+        self.assertIs(result, execute_concurrent.return_value)
+        execute_concurrent.assert_called_once_with(
+            session, session.prepare.return_value, params_list,
+            concurrency=10, results_generator=True)
+
+    @patch('utils.cassandra.Cluster')
+    def test_execute_prepared_async(self, cluster_class):
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        cluster = CassandraCluster(app=self.app)
+        session = cluster.session
+        session.execute_async.side_effect = [MagicMock(), MagicMock()]
+
+        futures = [
+            cluster.execute_prepared_async('select',
+                                           query='SELECT * FROM t WHERE id = ?',
+                                           params=(i,))
+            for i in range(2)
+        ]
+
+        session.prepare.assert_called_once_with('SELECT * FROM t WHERE id = ?')
+        session.execute_async.assert_called_with(session.prepare.return_value,
+                                                 (1,))
+        self.assertEqual(cluster.gather_async(futures),
+                         [future.result.return_value for future in futures])
+
+    def test_repr(self):
+        cluster = CassandraCluster(app=self.app)
+        self.assertEqual(repr(cluster),
+                         '<CassandraCluster cql://localhost:9042>')
+
+        self.app.config['CASSANDRA_NODES'] = ['one', 'two']
+        self.app.config['CASSANDRA_USER'] = 'username'
+        self.app.config['CASSANDRA_PASSWORD'] = 'password'
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        cluster.init_app(self.app)
+        self.assertEqual(
+            repr(cluster),
+            '<CassandraCluster cql://username:password@[one, two]:9042/test>')
+
+    @patch('utils.cassandra.Cluster')
+    def test_execute_after_force_prepare(self, cluster_class):
+        self.app.config['CASSANDRA_KEYSPACE'] = 'test'
+        cluster = CassandraCluster(app=self.app)
+        session = cluster.session
+
+        cluster.execute_prepared('select', query='SELECT 1')
+        session.prepare.return_value = MagicMock()
+        cluster.prepare_query('select', 'SELECT 1', force=True)
+        cluster.execute_prepared('select')
+
+        session.execute.assert_called_with(session.prepare.return_value, ())